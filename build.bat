@@ -1,6 +1,7 @@
 @echo off
 echo Building Binary Merger exe...
 python -m PyInstaller --noconfirm --onedir --windowed --name "BinaryMerger" src\main.py
-copy src\layout_config.json dist\BinaryMerger\
-copy src\style.qss dist\BinaryMerger\
+if not exist dist\BinaryMerger\config mkdir dist\BinaryMerger\config
+copy src\config\layout_config.json dist\BinaryMerger\config\
+copy src\config\style.qss dist\BinaryMerger\config\
 echo Build complete! The executable is in the dist folder.
@@ -7,7 +7,7 @@ from PySide6.QtWidgets import (
     QLabel, QLineEdit, QPushButton, QScrollArea, QProgressBar, QTextEdit,
     QFileDialog, QMessageBox
 )
-from PySide6.QtCore import Qt, Signal, QObject, QThread
+from PySide6.QtCore import Qt, Signal, Slot, QObject, QThread, QTimer
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from merger import merge_binaries
@@ -19,8 +19,24 @@ if getattr(sys, 'frozen', False):
 else:
     application_path = os.path.dirname(os.path.abspath(__file__))
 
-LAYOUT_FILE = os.path.join(application_path, "layout_config.json")
-STYLE_FILE = os.path.join(application_path, "style.qss")
+# Config files live in their own directory so the watcher is not woken by unrelated files next to the exe
+CONFIG_DIR = os.path.join(application_path, "config")
+LAYOUT_FILE = os.path.join(CONFIG_DIR, "layout_config.json")
+STYLE_FILE = os.path.join(CONFIG_DIR, "style.qss")
+
+# path -> (st_mtime_ns, st_size, parsed content)
+_cfg_cache: dict[str, tuple[int, int, object]] = {}
+
+def read_cached(path, parse):
+    """Read and parse a config file, reusing the previous result if its mtime and size are unchanged."""
+    st = os.stat(path)
+    cached = _cfg_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(path, "r", encoding="utf-8") as f:
+        content = parse(f)
+    _cfg_cache[path] = (st.st_mtime_ns, st.st_size, content)
+    return content
 
 class ConfigWatcher(QObject):
     config_changed = Signal()
@@ -29,22 +45,53 @@ class ConfigWatcher(QObject):
         super().__init__()
         self.watch_dir = watch_dir
         self.observer = Observer()
+        # Normalized so event paths match regardless of separators, case (Windows) or symlinks
+        self._watched = {
+            os.path.normcase(os.path.realpath(LAYOUT_FILE)),
+            os.path.normcase(os.path.realpath(STYLE_FILE)),
+        }
         
         class Handler(FileSystemEventHandler):
-            def __init__(self, signal):
+            def __init__(self, signal, watched):
                 self.signal = signal
+                self.watched = watched
             def on_modified(self, event):
-                if event.src_path.endswith(LAYOUT_FILE) or event.src_path.endswith(STYLE_FILE):
+                if os.path.normcase(os.path.realpath(event.src_path)) in self.watched:
                     self.signal.emit()
                     
-        self.handler = Handler(self.config_changed)
-        self.observer.schedule(self.handler, self.watch_dir, recursive=False)
+        self.handler = Handler(self.config_changed, self._watched)
+        # Scheduling a missing directory raises; load_config/load_style already log the missing files
+        if os.path.isdir(self.watch_dir):
+            self.observer.schedule(self.handler, self.watch_dir, recursive=False)
         self.observer.start()
 
     def stop(self):
         self.observer.stop()
         self.observer.join()
 
+class MergeWorker(QObject):
+    progress = Signal(int)
+    done = Signal(object, object)  # header size, total size (may exceed a C int)
+    error = Signal(str, str)  # message, traceback
+
+    def __init__(self, targets, output_filepath, sizes=None):
+        super().__init__()
+        self.targets = targets
+        self.output_filepath = output_filepath
+        self.sizes = sizes
+
+    @Slot()
+    def run(self):
+        try:
+            header_sz, total_sz = merge_binaries(self.targets, self.output_filepath, self.report_progress, self.sizes)
+        except Exception as e:
+            self.error.emit(str(e), traceback.format_exc())
+        else:
+            self.done.emit(header_sz, total_sz)
+
+    def report_progress(self, done, total):
+        self.progress.emit(done * 100 // total)
+
 class MergeRow(QWidget):
     removed = Signal(object)
 
@@ -99,13 +146,24 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.config = {}
         self.rows = []
+        self.merge_thread = None
+        self.merge_worker = None
+        self.merge_save_path = None
         
         self.init_ui()
         self.load_config()
         self.load_style()
+        self.add_target_rows(self.initial_row_count())
+        
+        # Editors fire several modify events per save; coalesce a burst into one reload
+        self._reload_timer = QTimer(self)
+        self._reload_timer.setSingleShot(True)
+        self._reload_timer.setInterval(200)
+        self._reload_timer.timeout.connect(self.reload_ui)
         
-        self.watcher = ConfigWatcher(application_path)
-        self.watcher.config_changed.connect(self.reload_ui)
+        self.watcher = ConfigWatcher(CONFIG_DIR)
+        # Emitted from the watchdog thread; queue it so the timer is restarted on the GUI thread
+        self.watcher.config_changed.connect(self._reload_timer.start, Qt.QueuedConnection)
         
     def init_ui(self):
         self.central_widget = QWidget()
@@ -149,12 +207,34 @@ class MainWindow(QMainWindow):
         self.console.setReadOnly(True)
         self.main_layout.addWidget(self.console)
         
+    def row_config(self):
+        row_conf = self.config.get("merge_row", {})
+        return row_conf if isinstance(row_conf, dict) else {}
+
+    def initial_row_count(self):
+        count = self.row_config().get("initial_rows", 0)
+        # bool is an int subclass, but true/false is not a row count
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            self.log(f"加載配置失敗: merge_row.initial_rows 應為非負整數，已使用 0 (got {count!r})")
+            return 0
+        return count
+
     def add_target_row(self):
-        ratios = self.config.get("merge_row", {})
+        ratios = self.row_config()
         row = MergeRow(ratios)
         row.removed.connect(self.remove_target_row)
         self.scroll_layout.addWidget(row)
         self.rows.append(row)
+
+    def add_target_rows(self, count):
+        # Suspend repaints while the rows are added so the list is painted once, not once per row
+        self.scroll_content.setUpdatesEnabled(False)
+        try:
+            for _ in range(count):
+                self.add_target_row()
+        finally:
+            self.scroll_content.setUpdatesEnabled(True)
+            self.scroll_content.update()
         
     def remove_target_row(self, row):
         self.scroll_layout.removeWidget(row)
@@ -164,9 +244,8 @@ class MainWindow(QMainWindow):
             
     def load_config(self):
         try:
-            with open(LAYOUT_FILE, "r", encoding="utf-8") as f:
-                self.config = json.load(f)
-                
+            self.config = read_cached(LAYOUT_FILE, json.load)
+
             win_conf = self.config.get("window", {})
             self.resize(win_conf.get("width", 800), win_conf.get("height", 600))
             self.setWindowTitle(win_conf.get("title", "Binary Merger"))
@@ -183,16 +262,15 @@ class MainWindow(QMainWindow):
 
     def load_style(self):
         try:
-            with open(STYLE_FILE, "r", encoding="utf-8") as f:
-                self.setStyleSheet(f.read())
+            style = read_cached(STYLE_FILE, lambda f: f.read())
+            # Re-applying an identical stylesheet still makes Qt re-polish every widget
+            if style != self.styleSheet():
+                self.setStyleSheet(style)
             self.log("樣式已加載 (Style loaded).")
         except Exception as e:
             self.log(f"加載樣式失敗: {str(e)}")
 
     def reload_ui(self):
-        # Watchdog triggers might be in a different thread, use QMetaObject.invokeMethod if needed
-        # But for simplicity, direct call usually works if not manipulating core UI loops heavily
-        # Better safe:
         self.load_config()
         self.load_style()
 
@@ -227,12 +305,14 @@ class MainWindow(QMainWindow):
         
         intervals = []
         overlaps_detected = []
+        sizes = {}  # merge_binaries rejects files whose size changed after this check
         
         for idx, target in enumerate(targets):
             filepath = target["path"]
             offset = target.get("offset", 0)
             try:
                 size = os.path.getsize(filepath)
+                sizes[filepath] = size
             except OSError:
                 self.log(f"無法讀取文件大小，跳過預先檢查: {filepath}")
                 continue
@@ -243,19 +323,31 @@ class MainWindow(QMainWindow):
                 offset = total_header_size
                 
             end_offset = offset + size
-            
-            # Check against previous intervals
-            for prev_idx, prev_start, prev_end, prev_path in intervals:
-                # If intervals intersect: (StartA < EndB) and (EndA > StartB)
-                if offset < prev_end and end_offset > prev_start:
-                    overlaps_detected.append(
-                        f"• {os.path.basename(prev_path)} 與 {os.path.basename(filepath)} \n"
-                        f"  (位址: 0x{prev_start:X}~0x{prev_end:X} 和 0x{offset:X}~0x{end_offset:X})"
-                    )
-            
-            intervals.append((idx, offset, end_offset, filepath))
+            intervals.append((idx, offset, end_offset, filepath, os.path.basename(filepath)))
             current_offset = end_offset
 
+        # Sweep intervals by start offset; `active` only keeps those not yet ended,
+        # so each interval is compared against the ones it can actually overlap
+        overlap_pairs = []
+        active = []
+        for cur in sorted(intervals, key=lambda iv: iv[1]):
+            _, start, end, _, _ = cur
+            active = [iv for iv in active if iv[2] > start]
+            for prev in active:
+                # If intervals intersect: (StartA < EndB) and (EndA > StartB)
+                if end > prev[1]:
+                    # Report in list order: the earlier target is the one being overwritten
+                    overlap_pairs.append((prev, cur) if prev[0] < cur[0] else (cur, prev))
+            active.append(cur)
+
+        # Keep the report in the order the targets were listed
+        overlap_pairs.sort(key=lambda pair: (pair[1][0], pair[0][0]))
+        for (_, prev_start, prev_end, _, prev_base), (_, offset, end_offset, _, base) in overlap_pairs:
+            overlaps_detected.append(
+                f"• {prev_base} 與 {base} \n"
+                f"  (位址: 0x{prev_start:X}~0x{prev_end:X} 和 0x{offset:X}~0x{end_offset:X})"
+            )
+
         if overlaps_detected:
             msg = "偵測到以下目標文件的寫入位址發生重疊：\n\n" + "\n".join(overlaps_detected) + "\n\n較後方的文件將會覆蓋前方的內容，是否繼續？"
             reply = QMessageBox.question(self, '重疊警告', msg, QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
@@ -268,18 +360,44 @@ class MainWindow(QMainWindow):
             self.log("已取消保存。")
             return
             
-        try:
-            header_sz, total_sz = merge_binaries(targets, save_path)
-            self.progress_bar.setValue(100)
-            self.log(f"合併成功！保存至: {save_path}")
-            self.log(f"標頭大小: 0x{header_sz:X}, 總大小: 0x{total_sz:X}")
-            QMessageBox.information(self, "成功", "文件合併完成！")
-        except Exception as e:
-            self.log(f"合併失敗: {traceback.format_exc()}")
-            QMessageBox.critical(self, "錯誤", f"合併時發生錯誤:\n{str(e)}")
+        # Merge on a worker thread so the UI and progress bar stay responsive
+        self.merge_btn.setEnabled(False)
+        self.merge_save_path = save_path
+        self.merge_thread = QThread(self)
+        self.merge_worker = MergeWorker(targets, save_path, sizes)
+        self.merge_worker.moveToThread(self.merge_thread)
+        self.merge_thread.started.connect(self.merge_worker.run)
+        self.merge_worker.progress.connect(self.progress_bar.setValue)
+        self.merge_worker.done.connect(self.on_merge_done)
+        self.merge_worker.error.connect(self.on_merge_error)
+        # Quit directly from the worker thread so closeEvent can wait() without the GUI event loop
+        self.merge_worker.done.connect(self.merge_thread.quit, Qt.DirectConnection)
+        self.merge_worker.error.connect(self.merge_thread.quit, Qt.DirectConnection)
+        self.merge_thread.finished.connect(self.on_merge_finished)
+        self.merge_thread.start()
+
+    def on_merge_done(self, header_sz, total_sz):
+        self.progress_bar.setValue(100)
+        self.log(f"合併成功！保存至: {self.merge_save_path}")
+        self.log(f"標頭大小: 0x{header_sz:X}, 總大小: 0x{total_sz:X}")
+        QMessageBox.information(self, "成功", "文件合併完成！")
+
+    def on_merge_error(self, message, tb):
+        self.log(f"合併失敗: {tb}")
+        QMessageBox.critical(self, "錯誤", f"合併時發生錯誤:\n{message}")
+
+    def on_merge_finished(self):
+        self.merge_worker.deleteLater()
+        self.merge_thread.deleteLater()
+        self.merge_worker = None
+        self.merge_thread = None
+        self.merge_btn.setEnabled(True)
 
     def closeEvent(self, event):
         self.watcher.stop()
+        # Let a running merge finish so the output file is not left half-written
+        if self.merge_thread is not None:
+            self.merge_thread.wait()
         event.accept()
 
 if __name__ == "__main__":
@@ -1,15 +1,79 @@
 import struct
-import binascii
+import bisect
+import heapq
+import mmap
 import os
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 AIO_MAGIC = b"AIOH"
 ELAN_VENDOR_ID = 0x04F3
 ELAN_PRODUCT_ID = b"\x08\x56"
-CRC32_POLY = 0xEDB88320  # binascii.crc32 uses this polynomial implicitly
+CRC32_POLY = 0xEDB88320  # zlib.crc32 uses this polynomial implicitly
+COPY_RANGE_THRESHOLD = 1 << 20  # Segments at least this large are copied in-kernel where supported
 
-def calculate_crc32(data: bytes) -> int:
-    """Calculate CRC32 for the given data."""
-    return binascii.crc32(data) & 0xFFFFFFFF
+# (path, st_ino, st_size, st_mtime_ns, st_ctime_ns) -> CRC32 of the whole file, reused across merges of unchanged inputs
+_crc_cache: dict[tuple[str, int, int, int, int], int] = {}
+# Files modified this recently are "racily clean": a same-size rewrite within the same mtime tick
+# (2 s on FAT/exFAT) would keep the same key, so their CRCs are not cached
+CRC_CACHE_RACY_NS = 3_000_000_000
+
+def calculate_crc32(data: bytes, value: int = 0) -> int:
+    """
+    Calculate CRC32 for the given data, continuing from a previous CRC `value`.
+    zlib.crc32 always goes through zlib's optimized CRC (and drops the GIL on large buffers),
+    whereas binascii.crc32 may fall back to a bytewise table on builds without zlib.
+    """
+    return zlib.crc32(data, value) & 0xFFFFFFFF
+
+def _crc32_multmodp(a: int, b: int) -> int:
+    """Multiply a and b modulo the CRC polynomial (both in zlib's reflected bit order)."""
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+# x^(2^n) modulo the CRC polynomial, for n = 0..31
+_CRC32_X2N = [1 << 30]
+for _ in range(31):
+    _CRC32_X2N.append(_crc32_multmodp(_CRC32_X2N[-1], _CRC32_X2N[-1]))
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """
+    Return the CRC32 of A + B given crc1 = CRC32(A), crc2 = CRC32(B) and len2 = len(B),
+    without touching the data (same as zlib's crc32_combine, which Python does not expose).
+    """
+    # crc1 * x^(8 * len2) mod P, computed by squaring
+    p = 1 << 31
+    n, k = len2, 3
+    while n:
+        if n & 1:
+            p = _crc32_multmodp(_CRC32_X2N[k & 31], p)
+        n >>= 1
+        k += 1
+    return _crc32_multmodp(p, crc1) ^ crc2
+
+# Fixed AIO Header content; only Header Size and FW Count depend on the merge
+_AIO_TEMPLATE = bytes(
+    AIO_MAGIC
+    + b"\x01\x00"  # Version, Little Endian 0x0001
+    + b"\x00\x00"  # Header Size, filled per merge
+    + b"\x01"  # Device Type
+    + b"\x78\x56\x34\x12"  # AIO FW Version 0x12345678 Little Endian
+    + b"\x00"  # Update Control
+    + b"\x00"  # FW Count, filled per merge
+    + b"\xFF" * 17  # Reserved
+)
+assert len(_AIO_TEMPLATE) == 0x20
 
 def generate_aio_header(fw_count: int) -> bytes:
     """
@@ -24,128 +88,297 @@ def generate_aio_header(fw_count: int) -> bytes:
     0x0E: FW Count (1B)
     0x0F: Reserved (17B) 0xFF
     """
-    total_header_size = 0x20 + (fw_count * 0x50)
-    magic = AIO_MAGIC
-    version = b"\x01\x00"  # Little Endian 0x0001
-    header_size = struct.pack("<H", total_header_size) # 2B
-    dev_type = b"\x01"
-    fw_version = b"\x78\x56\x34\x12" # 0x12345678 Little Endian
-    update_ctrl = b"\x00"
-    fw_count_byte = struct.pack("<B", fw_count)
-    reserved = b"\xFF" * 17
-    
-    header = magic + version + header_size + dev_type + fw_version + update_ctrl + fw_count_byte + reserved
-    assert len(header) == 0x20
-    return header
+    header = bytearray(_AIO_TEMPLATE)
+    struct.pack_into("<H", header, 0x06, 0x20 + (fw_count * 0x50))
+    struct.pack_into("<B", header, 0x0E, fw_count)
+    return bytes(header)
 
-def generate_elan_header(fw_offset: int, fw_size: int, crc32_val: int) -> bytes:
+# Fixed ELAN Header content; offset, size and CRC are filled per target
+_ELAN_TEMPLATE = bytearray(0x50)
+struct.pack_into("<H", _ELAN_TEMPLATE, 0x0000, ELAN_VENDOR_ID)  # Vendor ID 0x04F3
+_ELAN_TEMPLATE[0x0022:0x0024] = ELAN_PRODUCT_ID  # Product ID 0x08, 0x56
+_ELAN_TEMPLATE[0x0024:0x0026] = b"\xFF\xFF"  # Unique ID 0xFF, 0xFF
+_ELAN_TEMPLATE[0x0026:0x0028] = b"\x34\x12"  # FW Version 0x12, 0x34 Little endian
+_ELAN_TEMPLATE[0x0040:0x0050] = b"\xFF" * 16  # Reserved
+_ELAN_TEMPLATE = bytes(_ELAN_TEMPLATE)
+
+def write_elan_header(buf: bytearray, base: int, fw_offset: int, fw_size: int, crc32_val: int):
     """
-    Generate ELAN Header (0x50 bytes)
+    Write an ELAN Header (0x50 bytes) into buf at base.
+    0x0028: FW Data Offset (4B)
+    0x002C: FW Size (4B)
+    0x0030: CRC32 (16B total, 4B crc + 12B 0x00 pad)
+    The remaining fields are fixed and come from _ELAN_TEMPLATE.
     """
-    # Initialize with 0x00
-    header = bytearray(0x50)
-    
-    # 0x0000 Vendor ID 0x04F3
-    struct.pack_into("<H", header, 0x0000, ELAN_VENDOR_ID)
-    
-    # 0x0022 Product ID 0x08, 0x56
-    header[0x0022:0x0024] = ELAN_PRODUCT_ID
-    
-    # 0x0024 Unique ID 0xFF, 0xFF
-    header[0x0024:0x0026] = b"\xFF\xFF"
-    
-    # 0x0026 FW Version 0x12, 0x34
-    header[0x0026:0x0028] = b"\x34\x12"  # Little endian
-    
-    # 0x0028 FW Data Offset (4B)
-    struct.pack_into("<I", header, 0x0028, fw_offset)
-    
-    # 0x002C FW Size (4B)
-    struct.pack_into("<I", header, 0x002C, fw_size)
-    
-    # 0x0030 CRC32 (16B total, 4B crc + 12B pad)
-    struct.pack_into("<I", header, 0x0030, crc32_val)
-    # Remaining 12 bytes of CRC region are already 0x00 since we used bytearray
-    
-    # 0x0040 Reserved (16B) -> Fill with 0xFF
-    for i in range(0x40, 0x50):
-        header[i] = 0xFF
-        
-    return bytes(header)
+    buf[base:base + 0x50] = _ELAN_TEMPLATE
+    struct.pack_into("<III", buf, base + 0x0028, fw_offset, fw_size, crc32_val)
 
+def resolve_overlaps(fw_data_list: list[dict]) -> list[tuple[int, int, int]]:
+    """
+    Split the area covered by the targets into (start, end, owner) segments, sorted by start.
+    The owner is the index of the last target covering that range, since later targets overwrite earlier ones.
+    Uncovered gaps produce no segment.
+    """
+    bounds = sorted({pos for t in fw_data_list for pos in (t["offset"], t["offset"] + t["size"])})
+    order = sorted(range(len(fw_data_list)), key=lambda i: fw_data_list[i]["offset"])
 
+    segments = []
+    active = []  # heap of (-index, end) so the latest target is on top
+    nxt = 0
+    for seg_start, seg_end in zip(bounds, bounds[1:]):
+        while nxt < len(order) and fw_data_list[order[nxt]]["offset"] <= seg_start:
+            idx = order[nxt]
+            heapq.heappush(active, (-idx, fw_data_list[idx]["offset"] + fw_data_list[idx]["size"]))
+            nxt += 1
+        while active and active[0][1] <= seg_start:
+            heapq.heappop(active)
+        if active:
+            segments.append((seg_start, seg_end, -active[0][0]))
+    return segments
 
-def merge_binaries(targets: list[dict], output_filepath: str):
+def map_file(filepath: str, expected_size: int | None = None):
+    """
+    Map a whole file read-only so its pages are loaded on demand instead of copied onto the heap.
+    The returned stat comes from the mapped descriptor itself, so it always describes the mapped bytes.
+    expected_size (e.g. from a pre-flight check) must still match, otherwise the file changed in between.
+    Returns (data, stat, fd); empty files cannot be mapped and come back as b"".
+    fd is the mapped descriptor, kept open for copy_range where os.copy_file_range exists (otherwise None);
+    the caller closes it together with the mapping.
+    """
+    fd = os.open(filepath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        st = os.fstat(fd)
+        if expected_size is not None and st.st_size != expected_size:
+            raise ValueError(f"{filepath} changed size since it was checked (0x{expected_size:X} -> 0x{st.st_size:X})")
+        if st.st_size == 0:
+            return b"", st, None
+        data = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ)
+        # Copies must come from the same file that was mapped and CRC'd, even if the path is replaced since
+        return data, st, os.dup(fd) if hasattr(os, "copy_file_range") else None
+    finally:
+        # The mapping keeps its own handle
+        os.close(fd)
+
+def write_at(fd: int, data, offset: int):
+    """Write all of data at offset without moving through the file sequentially."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Windows has no pwrite
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+def copy_range(src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, count: int) -> bool:
+    """
+    Copy count bytes from src_fd into dst_fd entirely inside the kernel with os.copy_file_range
+    (Linux), which also lets the filesystem clone extents or do a server-side copy on NFS/SMB.
+    Returns False if the range could not be fully copied this way; the caller then writes it itself.
+    """
+    try:
+        while count > 0:
+            copied = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+            if copied == 0:
+                return False
+            src_offset += copied
+            dst_offset += copied
+            count -= copied
+        return True
+    except OSError:
+        # e.g. EXDEV across filesystems on older kernels, or unsupported by the filesystem
+        return False
+
+def _current_umask() -> int:
+    """Return the process umask; it can only be read by setting it, so it is set straight back."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def merge_binaries(targets: list[dict], output_filepath: str, progress_callback=None, sizes: dict[str, int] | None = None):
     """
     targets is a list of dicts: [{"path": "fw1.bin", "offset": 0x1000}, ...]
     If offset is 0 or less than all headers, it will be padded automatically.
+    progress_callback(done, total) is called after each FW is read, CRC'd and written.
+    sizes optionally maps paths to the sizes seen by a pre-flight check; a file whose size has
+    changed since then is rejected rather than merged with a stale layout.
     """
+    sizes = sizes or {}
+    # Write through a symlinked output to its target, as open(path, "wb") would, instead of replacing the link
+    output_filepath = os.path.realpath(output_filepath)
     fw_count = len(targets)
     total_header_size = 0x20 + (fw_count * 0x50)
+
+    steps_done = 0
+    def step():
+        nonlocal steps_done
+        steps_done += 1
+        if progress_callback:
+            progress_callback(steps_done, fw_count * 3)
     
-    # 1. Gather all file data
     fw_data_list = []
-    current_offset = total_header_size
-    
-    for target in targets:
-        filepath = target["path"]
-        offset = target.get("offset")
-        
-        with open(filepath, "rb") as f:
-            data = f.read()
-
-        # Offset rules:
-        # 1. offset is None: Append to the end of the previous binary (auto-append).
-        # 2. offset < total_header_size: Force user to place it *after* headers to prevent corrupting headers.
-        # 3. Explicit offset >= total_header_size: Place it exactly where asked, potentially overlapping/overwriting older data.
-        if offset is None:
-            offset = max(current_offset, total_header_size)
-        elif offset < total_header_size:
-            offset = total_header_size
-            
-        size = len(data)
-        fw_data_list.append({
-            "data": data,
-            "offset": offset,
-            "size": size
-        })
-        
-        current_offset = offset + size
-        
-    # 2. Construct the final binary (data only first)
-    # We create a bytearray up to the maximum offset + size
-    max_end = total_header_size
-    for target in fw_data_list:
-        end_pos = target["offset"] + target["size"]
-        if end_pos > max_end:
-            max_end = end_pos
-            
-    final_bin = bytearray(max_end)
-    
-    # Copy FW data to final_bin to resolve overlaps (later targets overwrite earlier ones)
-    for target in fw_data_list:
-        ofs = target["offset"]
-        sz = target["size"]
-        final_bin[ofs:ofs+sz] = target["data"]
-        
-    # 3. Calculate CRC based on the resolved overlapping data
-    for target in fw_data_list:
-        ofs = target["offset"]
-        sz = target["size"]
-        target["crc"] = calculate_crc32(final_bin[ofs:ofs+sz])
-        
-    # 4. Generate AIO Header
-    aio_header = generate_aio_header(fw_count)
-    
-    # 5. Generate ELAN Headers
-    elan_headers = b""
-    for target in fw_data_list:
-        elan_headers += generate_elan_header(target["offset"], target["size"], target["crc"])
-        
-    # 6. Copy headers definitively at 0x0000
-    final_bin[0:total_header_size] = aio_header + elan_headers
-    
-    with open(output_filepath, "wb") as f:
-        f.write(final_bin)
-        
+    views = []
+    tmp_path = None
+    try:
+        # 1. Map all file data
+        current_offset = total_header_size
+
+        for target in targets:
+            filepath = target["path"]
+            offset = target.get("offset")
+
+            data, st, fd = map_file(filepath, sizes.get(filepath))
+
+            # Offset rules:
+            # 1. offset is None: Append to the end of the previous binary (auto-append).
+            # 2. offset < total_header_size: Force user to place it *after* headers to prevent corrupting headers.
+            # 3. Explicit offset >= total_header_size: Place it exactly where asked, potentially overlapping/overwriting older data.
+            if offset is None:
+                offset = max(current_offset, total_header_size)
+            elif offset < total_header_size:
+                offset = total_header_size
+
+            size = len(data)
+            fw_data_list.append({
+                "data": data,
+                "fd": fd,
+                "offset": offset,
+                "size": size,
+                "crc_key": (filepath, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+            })
+
+            current_offset = offset + size
+            step()
+
+        # 2. Work out the final size; nothing is materialized in memory
+        max_end = total_header_size
+        for target in fw_data_list:
+            end_pos = target["offset"] + target["size"]
+            if end_pos > max_end:
+                max_end = end_pos
+
+        # 3. Calculate CRC based on the resolved overlapping data
+        # Every resolved segment is CRC'd once, from whichever target owns that byte range,
+        # and each target's CRC is spliced together from the segments its region spans.
+        segments = resolve_overlaps(fw_data_list)
+        seg_starts = [seg[0] for seg in segments]
+        # zlib.crc32 takes any buffer, so slicing views avoids copying each segment
+        views.extend(memoryview(target["data"]) for target in fw_data_list)
+
+        regions = []
+        for target in fw_data_list:
+            first = bisect.bisect_left(seg_starts, target["offset"])
+            regions.append(range(first, bisect.bisect_left(seg_starts, target["offset"] + target["size"], first)))
+
+        # Nothing overwrote an intact target, so its CRC is just the CRC of its unchanged file
+        intact = [all(segments[s][2] == idx for s in regions[idx]) for idx in range(fw_count)]
+
+        seg_crcs = {}
+        seg_users = {}  # segment index -> targets waiting on it
+        pending = {}  # target index -> number of segments still to CRC
+        for idx, target in enumerate(fw_data_list):
+            if intact[idx] and target["crc_key"] in _crc_cache:
+                target["crc"] = _crc_cache[target["crc_key"]]
+                continue
+            pending[idx] = len(regions[idx])
+            for s in regions[idx]:
+                seg_users.setdefault(s, []).append(idx)
+
+        def segment_crc(s):
+            seg_start, seg_end, owner = segments[s]
+            src_ofs = fw_data_list[owner]["offset"]
+            return calculate_crc32(views[owner][seg_start - src_ofs:seg_end - src_ofs])
+
+        def finish(idx):
+            target = fw_data_list[idx]
+            crc = 0
+            for s in regions[idx]:
+                crc = crc32_combine(crc, seg_crcs[s], segments[s][1] - segments[s][0])
+            target["crc"] = crc
+            if intact[idx] and time.time_ns() - target["crc_key"][3] >= CRC_CACHE_RACY_NS:
+                _crc_cache[target["crc_key"]] = crc
+
+        # Cached targets and empty regions are already done
+        for idx in range(fw_count):
+            if idx not in pending:
+                step()
+            elif pending[idx] == 0:
+                finish(idx)
+                step()
+
+        # Segments are independent and zlib.crc32 releases the GIL, so they are CRC'd in parallel
+        with ThreadPoolExecutor(max_workers=max(1, min(len(seg_users), os.cpu_count() or 1))) as executor:
+            futures = {executor.submit(segment_crc, s): s for s in seg_users}
+            for future in as_completed(futures):
+                s = futures[future]
+                seg_crcs[s] = future.result()
+                for idx in seg_users[s]:
+                    pending[idx] -= 1
+                    if pending[idx] == 0:
+                        finish(idx)
+                        step()
+
+        # 4. Generate AIO Header
+        headers = bytearray(total_header_size)
+        headers[0:0x20] = generate_aio_header(fw_count)
+
+        # 5. Generate ELAN Headers in place after the AIO Header
+        for idx, target in enumerate(fw_data_list):
+            write_elan_header(headers, 0x20 + idx * 0x50, target["offset"], target["size"], target["crc"])
+
+        # 6. Write to disk: the file is sized up front so gaps read as 0x00 (and stay sparse where
+        # the filesystem allows), then only the resolved segments and the headers are written,
+        # so overwritten bytes are never written twice.
+        # The image goes to a temp file next to the output and replaces it only once complete: the output
+        # may be one of the (still mapped) inputs, and a failed merge must not leave a header-less file behind.
+        owned = [[] for _ in fw_data_list]
+        for seg_start, seg_end, owner in segments:
+            owned[owner].append((seg_start, seg_end))
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".merge-", suffix=".tmp", dir=os.path.dirname(output_filepath))
+        try:
+            # Match what open(path, "wb") would leave: the existing file's mode, or the default for a new file
+            if os.path.exists(output_filepath):
+                shutil.copymode(output_filepath, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o666 & ~_current_umask())
+            os.ftruncate(fd, max_end)
+            for idx, target in enumerate(fw_data_list):
+                ofs = target["offset"]
+                for seg_start, seg_end in owned[idx]:
+                    length = seg_end - seg_start
+                    if (length < COPY_RANGE_THRESHOLD or target["fd"] is None
+                            or not copy_range(target["fd"], seg_start - ofs, fd, seg_start, length)):
+                        write_at(fd, views[idx][seg_start - ofs:seg_end - ofs], seg_start)
+                step()
+            write_at(fd, headers, 0)
+        finally:
+            os.close(fd)
+    except BaseException:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
+        raise
+    finally:
+        # Views must be released before their mappings can be closed
+        for view in views:
+            view.release()
+        for target in fw_data_list:
+            if isinstance(target["data"], mmap.mmap):
+                try:
+                    target["data"].close()
+                except BufferError:
+                    # A propagating traceback still holds a slice; the mapping is freed along with it
+                    pass
+            if target["fd"] is not None:
+                os.close(target["fd"])
+
+    # Only after the inputs are unmapped: Windows refuses to replace a mapped file
+    try:
+        os.replace(tmp_path, output_filepath)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
     return total_header_size, max_end
@@ -1,5 +1,5 @@
 import os
-from merger import merge_binaries, AIO_MAGIC
+from merger import merge_binaries, crc32_combine, AIO_MAGIC
 
 def create_dummy_file(filename, size, fill_byte):
     with open(filename, "wb") as f:
@@ -77,5 +77,240 @@ def test_merger():
     
     print("Overlap Overwrite Check Passed")
 
+    # CRC Check
+    # Each ELAN CRC must cover the resolved (post-overwrite) bytes of its region in the output
+    import binascii
+    for i in range(3):
+        base = 0x20 + i * 0x50
+        ofs, size, crc = struct.unpack("<III", data[base+0x28:base+0x34])
+        assert crc == binascii.crc32(data[ofs:ofs+size]) & 0xFFFFFFFF
+    print("CRC Check Passed")
+
+def test_crc32_combine():
+    import zlib
+    a = bytes(range(256)) * 3
+    b = b"\xAA" * 0x1000 + b"\x55" * 7
+    assert crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(a + b)
+    assert crc32_combine(0, zlib.crc32(b), len(b)) == zlib.crc32(b)
+    assert crc32_combine(zlib.crc32(a), 0, 0) == zlib.crc32(a)
+    print("CRC32 Combine Check Passed")
+
+def test_gap_fill():
+    # The output is never built in memory; gaps come from extending the file and must read back as 0x00
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw1_file = os.path.join(test_dir, "gap1.bin")
+    fw2_file = os.path.join(test_dir, "gap2.bin")
+    output_file = os.path.join(test_dir, "merged_gap.bin")
+    create_dummy_file(fw1_file, 0x100, 0xAA)
+    create_dummy_file(fw2_file, 0x100, 0xBB)
+
+    header_size, total_size = merge_binaries([
+        {"path": fw1_file, "offset": None},
+        {"path": fw2_file, "offset": 0x100000}
+    ], output_file)
+    assert total_size == 0x100100
+
+    with open(output_file, "rb") as f:
+        data = f.read()
+
+    assert len(data) == total_size
+    assert data[header_size:header_size+0x100] == b"\xAA" * 0x100
+    assert data[header_size+0x100:0x100000] == bytes(0x100000 - header_size - 0x100)
+    assert data[0x100000:] == b"\xBB" * 0x100
+    print("Gap Fill Check Passed")
+
+def test_output_is_input():
+    # Merging into one of the inputs must use that input's original bytes, not a truncated file
+    import struct, zlib
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw1_file = os.path.join(test_dir, "self1.bin")
+    fw2_file = os.path.join(test_dir, "self2.bin")
+    create_dummy_file(fw1_file, 0x3000, 0xAA)
+    create_dummy_file(fw2_file, 0x100, 0xBB)
+
+    header_size, total_size = merge_binaries([
+        {"path": fw1_file, "offset": None},
+        {"path": fw2_file, "offset": None}
+    ], fw1_file)
+
+    with open(fw1_file, "rb") as f:
+        data = f.read()
+
+    assert len(data) == total_size
+    assert data[header_size:header_size+0x3000] == b"\xAA" * 0x3000
+    assert data[header_size+0x3000:] == b"\xBB" * 0x100
+    ofs, size, crc = struct.unpack("<III", data[0x20+0x28:0x20+0x34])
+    assert crc == zlib.crc32(data[ofs:ofs+size])
+    assert not [name for name in os.listdir(test_dir) if name.endswith(".tmp")]
+    print("Output Is Input Check Passed")
+
+def test_crc_cache():
+    # A rewritten input with the same size must not reuse the CRC cached for its old content
+    import struct, zlib
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw_file = os.path.join(test_dir, "cached.bin")
+    output_file = os.path.join(test_dir, "merged_cached.bin")
+    create_dummy_file(fw_file, 0x400, 0x11)
+    merge_binaries([{"path": fw_file, "offset": None}], output_file)
+    size_before = os.path.getsize(fw_file)
+
+    st = os.stat(fw_file)
+    create_dummy_file(fw_file, 0x400, 0x22)
+    os.utime(fw_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    # The pre-flight size still matches, so the merge goes ahead with the new content
+    merge_binaries([{"path": fw_file, "offset": None}], output_file, sizes={fw_file: size_before})
+    with open(output_file, "rb") as f:
+        data = f.read()
+    ofs, size, crc = struct.unpack("<III", data[0x20+0x28:0x20+0x34])
+    assert data[ofs:ofs+size] == b"\x22" * 0x400
+    assert crc == zlib.crc32(data[ofs:ofs+size])
+
+    # Same size and the same mtime, as a fast rebuild on a coarse-mtime filesystem would leave it
+    st = os.stat(fw_file)
+    create_dummy_file(fw_file, 0x400, 0x44)
+    os.utime(fw_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    merge_binaries([{"path": fw_file, "offset": None}], output_file)
+    with open(output_file, "rb") as f:
+        data = f.read()
+    ofs, size, crc = struct.unpack("<III", data[0x20+0x28:0x20+0x34])
+    assert data[ofs:ofs+size] == b"\x44" * 0x400
+    assert crc == zlib.crc32(data[ofs:ofs+size])
+
+    # A size that changed since the pre-flight check is rejected
+    create_dummy_file(fw_file, 0x500, 0x33)
+    try:
+        merge_binaries([{"path": fw_file, "offset": None}], output_file, sizes={fw_file: size_before})
+    except ValueError:
+        pass
+    else:
+        assert False, "stale pre-flight size was not rejected"
+    print("CRC Cache Check Passed")
+
+def test_copy_range():
+    # Force every segment through the in-kernel copy path and compare the output byte-for-byte
+    import merger
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw1_file = os.path.join(test_dir, "range1.bin")
+    fw2_file = os.path.join(test_dir, "range2.bin")
+    output_file = os.path.join(test_dir, "merged_range.bin")
+    fw1 = bytes(range(256)) * 0x30
+    fw2 = bytes(reversed(range(256))) * 0x08
+    with open(fw1_file, "wb") as f:
+        f.write(fw1)
+    with open(fw2_file, "wb") as f:
+        f.write(fw2)
+
+    # fw2 lands in the middle of fw1, so fw1's tail segment is copied from a non-zero source offset
+    attempts = []
+    original_copy_file_range = getattr(os, "copy_file_range", None)
+    if original_copy_file_range:
+        def counting_copy_file_range(*args):
+            # Count before calling: filesystems without support raise, and the write_at fallback is still correct
+            attempts.append(args)
+            return original_copy_file_range(*args)
+        os.copy_file_range = counting_copy_file_range
+    original_threshold = merger.COPY_RANGE_THRESHOLD
+    merger.COPY_RANGE_THRESHOLD = 1
+    try:
+        header_size, total_size = merge_binaries([
+            {"path": fw1_file, "offset": None},
+            {"path": fw2_file, "offset": 0x1000}
+        ], output_file)
+    finally:
+        merger.COPY_RANGE_THRESHOLD = original_threshold
+        if original_copy_file_range:
+            os.copy_file_range = original_copy_file_range
+
+    expected = bytearray(total_size)
+    expected[header_size:header_size+len(fw1)] = fw1
+    expected[0x1000:0x1000+len(fw2)] = fw2
+    with open(output_file, "rb") as f:
+        data = f.read()
+    assert data[header_size:] == bytes(expected[header_size:])
+    if original_copy_file_range:
+        # Head and tail of fw1 plus all of fw2
+        assert len(attempts) >= 3
+    print("Copy Range Check Passed")
+
+def test_copy_range_replaced_input():
+    # An input replaced by rename after its CRC was taken must not leak into the output via copy_range
+    import merger, struct, tempfile, zlib
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw_file = os.path.join(test_dir, "swapped.bin")
+    new_file = os.path.join(test_dir, "swapped.new")
+    output_file = os.path.join(test_dir, "merged_swapped.bin")
+    create_dummy_file(fw_file, 0x2000, 0xAA)
+    create_dummy_file(new_file, 0x2000, 0x55)
+
+    # The temp output is created right after the CRC pass, just before the data is written
+    original_mkstemp = tempfile.mkstemp
+    def swapping_mkstemp(*args, **kwargs):
+        os.replace(new_file, fw_file)
+        return original_mkstemp(*args, **kwargs)
+    original_threshold = merger.COPY_RANGE_THRESHOLD
+    merger.COPY_RANGE_THRESHOLD = 1
+    tempfile.mkstemp = swapping_mkstemp
+    try:
+        merge_binaries([{"path": fw_file, "offset": None}], output_file)
+    finally:
+        tempfile.mkstemp = original_mkstemp
+        merger.COPY_RANGE_THRESHOLD = original_threshold
+
+    with open(output_file, "rb") as f:
+        data = f.read()
+    ofs, size, crc = struct.unpack("<III", data[0x20+0x28:0x20+0x34])
+    assert data[ofs:ofs+size] == b"\xAA" * 0x2000
+    assert crc == zlib.crc32(data[ofs:ofs+size])
+    print("Copy Range Replaced Input Check Passed")
+
+def test_output_mode_and_symlink():
+    # Replacing the output must keep its mode and write through a symlink to the real file
+    import stat
+    test_dir = "test_data"
+    os.makedirs(test_dir, exist_ok=True)
+
+    fw_file = os.path.join(test_dir, "mode.bin")
+    output_file = os.path.join(test_dir, "merged_mode.bin")
+    link_file = os.path.join(test_dir, "merged_link.bin")
+    create_dummy_file(fw_file, 0x100, 0xAA)
+    create_dummy_file(output_file, 0x10, 0x00)
+    os.chmod(output_file, 0o600)
+    if os.path.lexists(link_file):
+        os.remove(link_file)
+
+    merge_binaries([{"path": fw_file, "offset": None}], output_file)
+    if os.name == "posix":
+        assert stat.S_IMODE(os.stat(output_file).st_mode) == 0o600
+
+    try:
+        os.symlink(os.path.basename(output_file), link_file)
+    except (OSError, NotImplementedError):
+        print("Output Mode Check Passed (symlinks unavailable)")
+        return
+    create_dummy_file(fw_file, 0x100, 0xBB)
+    merge_binaries([{"path": fw_file, "offset": None}], link_file)
+    assert os.path.islink(link_file)
+    with open(output_file, "rb") as f:
+        assert f.read()[-1] == 0xBB
+    print("Output Mode And Symlink Check Passed")
+
 if __name__ == "__main__":
     test_merger()
+    test_crc32_combine()
+    test_gap_fill()
+    test_output_is_input()
+    test_crc_cache()
+    test_copy_range()
+    test_copy_range_replaced_input()
+    test_output_mode_and_symlink()